@@ -8,194 +8,428 @@ import time
 import random
 import logging
 import threading
-from flask import Flask
+import asyncio
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
+from sortedcontainers import SortedKeyList
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+
+# Use orjson for leaderboard (de)serialization when it is installed
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, indent=4).encode()
+    _loads = json.loads
 
 # Load environment variables
 load_dotenv()
 
-# --- Flask for Health Checks ---
-app = Flask(__name__)
+# --- HTTP Server for Health Checks ---
+_HEALTH_BODY = b"Shroom Game is running"
+_HEALTH_HEADERS = (
+    b"HTTP/1.0 200 OK\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Content-Length: " + str(len(_HEALTH_BODY)).encode() + b"\r\n"
+    b"\r\n"
+)
+_HEALTH_RESPONSE = _HEALTH_HEADERS + _HEALTH_BODY
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Answer GET and HEAD / with a static health message."""
+    def do_GET(self):
+        self._respond(_HEALTH_RESPONSE)
+
+    def do_HEAD(self):
+        self._respond(_HEALTH_HEADERS)
 
-@app.route("/")
-def health():
-    return "Shroom Game is running", 200
+    def _respond(self, response):
+        if self.path.partition("?")[0] != "/":
+            self.send_error(404)
+            return
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
 
 def run_http_server():
     port = int(os.environ.get("PORT", 8080))
-    app.run(host="0.0.0.0", port=port)
+    server = ThreadingHTTPServer(("0.0.0.0", port), HealthHandler)
+    server.daemon_threads = True
+    server.serve_forever()
 
 # --- Logging Setup ---
+# Pass log arguments %-style so messages are only formatted when the level is enabled.
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # otherwise logs every getUpdates call
 logger = logging.getLogger(__name__)
 
 # --- Game Settings ---
 BOARD_SIZE = 10
+BOARD_CELLS = BOARD_SIZE * BOARD_SIZE  # board buffer cells are indexed y * BOARD_SIZE + x
 ROUND_DURATION = 60
 MAX_MUSHROOMS = 5
+EDIT_INTERVAL = 0.1  # minimum seconds between board edits per chat
 LEADERBOARD_FILE = "leaderboard.json"
+LEADERBOARD_SAVE_INTERVAL = 5  # seconds between background leaderboard writes
+LEADERBOARD_TOP_K = 20  # players shown by /leaderboard
+GLYPHS = ('⬜', '🍄', '🐦', '🙂')
+EMPTY_LINE = GLYPHS[0] * BOARD_SIZE
+# Keyed by button callback_data: up, down, left, right
+MOVES = {'0': (0, -1), '1': (0, 1), '2': (-1, 0), '3': (1, 0)}
+_MOVE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Up", callback_data="0")],
+    [InlineKeyboardButton("Left", callback_data="2"), InlineKeyboardButton("Right", callback_data="3")],
+    [InlineKeyboardButton("Down", callback_data="1")]
+])
+
+@dataclass(slots=True)
+class GameState:
+    """Per-chat game state, reused across games via reset()."""
+    level: int = 0
+    score: int = 0
+    collected: int = 0
+    required: int = 0
+    player_pos: tuple = (0, 0)
+    raven_pos: tuple = (0, 0)
+    mushrooms: set = field(default_factory=set)
+    deadline: float = 0.0
+    user_id: int = 0
+    username: str = ""
+    last_render_text: str = ""
+    stats_prefix: str = ""
+    last_edit_ts: float = 0.0
+    flush_pending: bool = False
+    flush_task: asyncio.Task | None = None  # latest flush_board task, possibly still editing
+    board: bytearray = field(default_factory=lambda: bytearray(BOARD_CELLS))  # indices into GLYPHS
+    drawn: list = field(default_factory=list)  # board cells set by the previous render
+    lines: list = field(default_factory=lambda: [EMPTY_LINE] * BOARD_SIZE)  # rendered rows of board
+
+    def reset(self, user_id, username):
+        """Start a new game, keeping the board buffer from any previous one."""
+        self.level = 1
+        self.score = 0
+        self.collected = 0
+        self.required = 3
+        self.player_pos = (0, 0)
+        self.raven_pos = (BOARD_SIZE - 1, BOARD_SIZE - 1)
+        self.mushrooms.clear()
+        self.deadline = time.monotonic() + ROUND_DURATION
+        self.user_id = user_id
+        self.username = username
+        self.last_render_text = ""
+        self.last_edit_ts = 0.0
+        self.flush_pending = False
+        self.flush_task = None
+
+# Dedicated RNG for board placement
+_rng = random.Random()
 
 # Global state storage
-game_states = {}
+game_states: dict[int, GameState] = {}
+per_chat_locks: dict[int, asyncio.Lock] = {}  # only for chats with a live game
+_STATE_POOL: deque[GameState] = deque(maxlen=64)  # finished games kept for reuse
+
+# In-memory leaderboard, loaded in main() and written back by the saver thread
+_LEADERBOARD = {}
+_SORTED = SortedKeyList(key=lambda entry: -entry[1]["score"])  # (user_id, data), best first
+_LB_LOCK = threading.Lock()
+_LB_SAVE_LOCK = threading.Lock()  # held for a whole snapshot + write + replace
+_lb_dirty = False
+_lb_version = 0  # bumped on every leaderboard change
+_LB_TEXT_CACHE = {"version": -1, "text": None}
 
 # --- Leaderboard Functions ---
 def load_leaderboard():
     """Load leaderboard data from JSON."""
     if os.path.exists(LEADERBOARD_FILE):
-        with open(LEADERBOARD_FILE, "r") as file:
-            return json.load(file)
+        with open(LEADERBOARD_FILE, "rb") as file:
+            return _loads(file.read())
     return {}
 
 def save_leaderboard(leaderboard):
-    """Save leaderboard data to JSON."""
-    with open(LEADERBOARD_FILE, "w") as file:
-        json.dump(leaderboard, file, indent=4)
+    """Save leaderboard data to JSON, replacing the file atomically."""
+    data = _dumps(leaderboard)
+    tmp_file = LEADERBOARD_FILE + ".tmp"
+    with open(tmp_file, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, LEADERBOARD_FILE)
+
+def init_leaderboard():
+    """Load the saved leaderboard into memory."""
+    global _lb_version
+    with _LB_LOCK:
+        _LEADERBOARD.update(load_leaderboard())
+        _SORTED.update(_LEADERBOARD.items())
+        _lb_version += 1
+
+def flush_leaderboard():
+    """Write the in-memory leaderboard to disk if it has changed."""
+    global _lb_dirty
+    with _LB_SAVE_LOCK:
+        with _LB_LOCK:
+            if not _lb_dirty:
+                return
+            snapshot = dict(_LEADERBOARD)
+            _lb_dirty = False
+        try:
+            save_leaderboard(snapshot)
+        except BaseException:
+            with _LB_LOCK:
+                _lb_dirty = True  # retry on the next flush
+            raise
+
+def run_leaderboard_saver():
+    """Periodically persist leaderboard changes in the background."""
+    while True:
+        time.sleep(LEADERBOARD_SAVE_INTERVAL)
+        try:
+            flush_leaderboard()
+        except Exception:
+            logger.exception("Failed to save leaderboard")
 
 def update_leaderboard(user_id, username, score):
     """Update leaderboard with player's score."""
-    leaderboard = load_leaderboard()
-    if user_id not in leaderboard or score > leaderboard[user_id]["score"]:
-        leaderboard[user_id] = {"username": username, "score": score}
-        save_leaderboard(leaderboard)
+    global _lb_dirty, _lb_version
+    user_id = str(user_id)  # JSON object keys are always strings
+    with _LB_LOCK:
+        old = _LEADERBOARD.get(user_id)
+        if old is None or score > old["score"]:
+            if old is not None:
+                _SORTED.remove((user_id, old))
+            data = {"username": username, "score": score}
+            _LEADERBOARD[user_id] = data
+            _SORTED.add((user_id, data))
+            _lb_dirty = True
+            _lb_version += 1
 
 def get_leaderboard_text():
     """Generate a formatted leaderboard message."""
-    leaderboard = load_leaderboard()
-    sorted_players = sorted(leaderboard.items(), key=lambda x: x[1]["score"], reverse=True)
-    if not sorted_players:
-        return "No scores yet! Be the first to climb the ranks."
-
-    text = "**🏆 Leaderboard 🏆**\n"
-    for rank, (user_id, data) in enumerate(sorted_players, start=1):
-        text += f"{rank}. {data['username']} - {data['score']} points\n"
+    with _LB_LOCK:
+        if _LB_TEXT_CACHE["version"] == _lb_version:
+            return _LB_TEXT_CACHE["text"]
+
+        if not _SORTED:
+            text = "No scores yet! Be the first to climb the ranks."
+        else:
+            lines = ["**🏆 Leaderboard 🏆**"]
+            for rank, (user_id, data) in enumerate(_SORTED.islice(0, LEADERBOARD_TOP_K), start=1):
+                lines.append(f"{rank}. {data['username']} - {data['score']} points")
+            text = "\n".join(lines)
+        _LB_TEXT_CACHE.update(version=_lb_version, text=text)
     return text
 
 # --- Game Functions ---
 def init_game(chat_id, username):
     """Initialize a new game state for the given chat."""
-    state = {
-        'level': 1,
-        'score': 0,
-        'collected': 0,
-        'required': 3,
-        'player_pos': (0, 0),
-        'raven_pos': (BOARD_SIZE - 1, BOARD_SIZE - 1),
-        'mushrooms': [],
-        'start_time': time.time(),
-        'user_id': chat_id,
-        'username': username
-    }
+    if chat_id in game_states:
+        end_game(chat_id)
+    state = _STATE_POOL.pop() if _STATE_POOL else GameState()
+    state.reset(chat_id, username)
+    _refresh_prefix(state)
     for _ in range(3):
         spawn_mushroom(state)
     game_states[chat_id] = state
+    per_chat_locks[chat_id] = asyncio.Lock()
+
+def end_game(chat_id):
+    """Remove a chat's game and keep its state object for reuse."""
+    state = game_states.pop(chat_id)
+    per_chat_locks.pop(chat_id, None)
+    # A pending flush_board task still refers to the old state
+    if not state.flush_pending:
+        _STATE_POOL.append(state)
+
+def _refresh_prefix(state):
+    """Rebuild the cached stats line after level, score or progress changes."""
+    state.stats_prefix = f"Level: {state.level}  Score: {state.score}  Collected: {state.collected}/{state.required}"
 
-def render_board(state):
+def render_board(state, time_left=None):
     """Create a visual representation of the game board."""
-    board = [['⬜' for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)]
-    for (x, y) in state['mushrooms']:
-        board[y][x] = '🍄'
-    rx, ry = state['raven_pos']
-    board[ry][rx] = '🐦'
-    px, py = state['player_pos']
-    board[py][px] = '🙂'
-    time_left = max(0, int(state['start_time'] + ROUND_DURATION - time.time()))
-    stats = f"Level: {state['level']}  Score: {state['score']}  Collected: {state['collected']}/{state['required']}\nTime Left: {time_left}s"
-    return "\n".join(["".join(row) for row in board]) + "\n" + stats
+    buf = state.board
+    previous = {i: buf[i] for i in state.drawn}
+    for i in previous:
+        buf[i] = 0
+    drawn = [y * BOARD_SIZE + x for (x, y) in state.mushrooms]
+    for i in drawn:
+        buf[i] = 1
+    rx, ry = state.raven_pos
+    px, py = state.player_pos
+    raven, player = ry * BOARD_SIZE + rx, py * BOARD_SIZE + px
+    buf[raven] = 2
+    buf[player] = 3
+    drawn += (raven, player)
+    state.drawn = drawn
+    # Only rebuild the cached rows whose cells actually changed since the last render
+    lines = state.lines
+    for y in {i // BOARD_SIZE for i in previous.keys() | drawn if buf[i] != previous.get(i, 0)}:
+        start = y * BOARD_SIZE
+        row = buf[start:start + BOARD_SIZE]
+        lines[y] = "".join([GLYPHS[cell] for cell in row]) if any(row) else EMPTY_LINE
+    if time_left is None:
+        time_left = state.deadline - time.monotonic()
+    return "\n".join((*lines, state.stats_prefix + "\nTime Left: " + str(max(0, int(time_left))) + "s"))
 
 def spawn_mushroom(state):
     """Generate a new mushroom at a random location."""
-    if len(state['mushrooms']) >= MAX_MUSHROOMS:
+    if len(state.mushrooms) >= MAX_MUSHROOMS:
         return
-    while True:
-        x, y = random.randint(0, BOARD_SIZE - 1), random.randint(0, BOARD_SIZE - 1)
-        if (x, y) in [state['player_pos'], state['raven_pos']] or (x, y) in state['mushrooms']:
-            continue
-        state['mushrooms'].append((x, y))
-        break
-
-def move_raven(state):
-    """Move the raven closer to the nearest mushroom."""
-    rx, ry = state['raven_pos']
-    if state['mushrooms']:
-        target = min(state['mushrooms'], key=lambda pos: abs(pos[0]-rx) + abs(pos[1]-ry))
-        dx, dy = (1 if target[0] > rx else -1 if target[0] < rx else 0), (1 if target[1] > ry else -1 if target[1] < ry else 0)
-        state['raven_pos'] = (rx + dx, ry + dy)
-
-def update_game_state(chat_id, move_direction):
+    occupied = sorted({y * BOARD_SIZE + x for (x, y) in state.mushrooms | {state.player_pos, state.raven_pos}})
+    free = BOARD_CELLS - len(occupied)
+    if free <= 0:
+        return
+    # Pick the n-th free cell by stepping over the occupied cells below it
+    cell = _rng.randrange(free)
+    for taken in occupied:
+        if taken > cell:
+            break
+        cell += 1
+    state.mushrooms.add((cell % BOARD_SIZE, cell // BOARD_SIZE))
+
+def move_raven(rx, ry, mushrooms):
+    """Return the raven's next position, one step closer to the nearest mushroom."""
+    if not mushrooms:
+        return rx, ry
+    tx = ty = 0
+    best_dist = 1 << 30
+    for (mx, my) in mushrooms:
+        ddx = mx - rx
+        ddy = my - ry
+        dist = (ddx if ddx >= 0 else -ddx) + (ddy if ddy >= 0 else -ddy)
+        if dist < best_dist:
+            best_dist = dist
+            tx, ty = mx, my
+    return rx + (tx > rx) - (tx < rx), ry + (ty > ry) - (ty < ry)
+
+async def update_game_state(chat_id, move_direction):
     """Update the game state based on player's move."""
-    state = game_states.get(chat_id)
-    if not state:
+    lock = per_chat_locks.get(chat_id)
+    if lock is None:
         return "Game not started. Use /start to begin."
+    async with lock:
+        state = game_states.get(chat_id)
+        if not state:
+            return "Game not started. Use /start to begin."
+
+        time_left = state.deadline - time.monotonic()
+        if time_left <= 0:
+            update_leaderboard(state.user_id, state.username, state.score)
+            msg = f"Time's up! You scored {state.score} points.\n"
+            end_game(chat_id)
+            return msg + "Use /leaderboard to view rankings."
+
+        px, py = state.player_pos
+        dx, dy = MOVES.get(move_direction, (0, 0))
+        edge = BOARD_SIZE - 1
+        new_pos = (min(max(px + dx, 0), edge), min(max(py + dy, 0), edge))
+
+        state.player_pos = new_pos
+        if new_pos in state.mushrooms:
+            state.mushrooms.discard(new_pos)
+            state.score += 10
+            state.collected += 1
+            _refresh_prefix(state)
 
-    time_left = state['start_time'] + ROUND_DURATION - time.time()
-    if time_left <= 0:
-        update_leaderboard(state['user_id'], state['username'], state['score'])
-        msg = f"Time's up! You scored {state['score']} points.\n"
-        del game_states[chat_id]
-        return msg + "Use /leaderboard to view rankings."
-
-    px, py = state['player_pos']
-    new_pos = {
-        'up': (px, max(py - 1, 0)),
-        'down': (px, min(py + 1, BOARD_SIZE - 1)),
-        'left': (max(px - 1, 0), py),
-        'right': (min(px + 1, BOARD_SIZE - 1), py)
-    }.get(move_direction, (px, py))
-    
-    state['player_pos'] = new_pos
-    if new_pos in state['mushrooms']:
-        state['mushrooms'].remove(new_pos)
-        state['score'] += 10
-        state['collected'] += 1
-
-    move_raven(state)
-    if state['player_pos'] == state['raven_pos']:
-        update_leaderboard(state['user_id'], state['username'], state['score'])
-        del game_states[chat_id]
-        return "Oh no! The raven caught you. Game over!\nUse /leaderboard to view rankings."
-
-    return render_board(state)
+        rx, ry = state.raven_pos
+        state.raven_pos = move_raven(rx, ry, state.mushrooms)
+        if new_pos == state.raven_pos:
+            update_leaderboard(state.user_id, state.username, state.score)
+            end_game(chat_id)
+            return "Oh no! The raven caught you. Game over!\nUse /leaderboard to view rankings."
+
+        return render_board(state, time_left)
 
 # --- Telegram Handlers ---
-def start_game(update: Update, context: CallbackContext):
+async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start a new game."""
     chat_id = update.effective_chat.id
     username = update.effective_chat.username or f"Player {chat_id}"
     init_game(chat_id, username)
+    logger.debug("New game for %s in chat %s", username, chat_id)
     state = game_states[chat_id]
-    update.message.reply_text(render_board(state), reply_markup=get_move_keyboard())
+    state.last_render_text = render_board(state)
+    await update.message.reply_text(state.last_render_text, reply_markup=_MOVE_KEYBOARD)
 
-def leaderboard(update: Update, context: CallbackContext):
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display the leaderboard."""
-    update.message.reply_text(get_leaderboard_text())
+    await update.message.reply_text(get_leaderboard_text())
 
-def move_handler(update: Update, context: CallbackContext):
+async def move_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle movement buttons."""
     query = update.callback_query
     chat_id = query.message.chat_id
     move_direction = query.data
-    query.edit_message_text(text=update_game_state(chat_id, move_direction), reply_markup=get_move_keyboard())
+    logger.debug("Move %s in chat %s", move_direction, chat_id)
+    previous = game_states.get(chat_id)
+    text = await update_game_state(chat_id, move_direction)
+    state = game_states.get(chat_id)
+    if state is None:
+        if previous is not None and previous.flush_task is not None:
+            # Let a coalesced edit finish so it cannot overwrite the final message
+            await asyncio.wait({previous.flush_task})
+        await query.edit_message_text(text=text, reply_markup=_MOVE_KEYBOARD)
+        return
+    if state.flush_pending:
+        # flush_board is running and will show this move too, so spend no API call on it
+        return
+    wait = state.last_edit_ts + EDIT_INTERVAL - time.monotonic()
+    if wait > 0:
+        state.flush_pending = True
+        logger.debug("Deferring board edit for chat %s by %.3fs", chat_id, wait)
+        state.flush_task = context.application.create_task(flush_board(chat_id, state, query, wait))
+        return
+    await edit_board(state, query, text)
+
+async def edit_board(state, query, text, answered=False):
+    """Edit the game message to show the given board text."""
+    # Telegram rejects edits that would leave the message unchanged.
+    if text == state.last_render_text:
+        if not answered:
+            await query.answer()
+        return
+    state.last_render_text = text
+    await query.edit_message_text(text=text, reply_markup=_MOVE_KEYBOARD)
+    # Measure the interval from when Telegram finished the edit, not from when it was sent
+    state.last_edit_ts = time.monotonic()
 
-def get_move_keyboard():
-    """Create inline keyboard for movement."""
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("Up", callback_data="up")],
-        [InlineKeyboardButton("Left", callback_data="left"), InlineKeyboardButton("Right", callback_data="right")],
-        [InlineKeyboardButton("Down", callback_data="down")]
-    ])
+async def flush_board(chat_id, state, query, delay):
+    """Keep the board in sync during rapid button presses, editing at most once per EDIT_INTERVAL."""
+    try:
+        await asyncio.sleep(delay)
+        # Presses that arrive while an edit is in flight are picked up on the next pass
+        while game_states.get(chat_id) is state:
+            text = render_board(state)
+            if text == state.last_render_text:
+                break
+            await edit_board(state, query, text, answered=True)
+            await asyncio.sleep(EDIT_INTERVAL)
+    finally:
+        state.flush_pending = False
 
 def main():
     TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
-    dp.add_handler(CommandHandler("start", start_game))
-    dp.add_handler(CommandHandler("leaderboard", leaderboard))
-    dp.add_handler(CallbackQueryHandler(move_handler))
-    threading.Thread(target=run_http_server, daemon=True).start()
-    updater.start_polling()
-    updater.idle()
+    init_leaderboard()
+    get_leaderboard_text()  # warm the text cache before the first /leaderboard
+    application = Application.builder().token(TOKEN).build()
+    application.add_handler(CommandHandler("start", start_game))
+    application.add_handler(CommandHandler("leaderboard", leaderboard))
+    application.add_handler(CallbackQueryHandler(move_handler))
+    # Hosting platforms that probe health set PORT; plain local runs usually don't
+    if os.environ.get("ENABLE_HEALTH", "1" if "PORT" in os.environ else "0") == "1":
+        threading.Thread(target=run_http_server, daemon=True).start()
+    threading.Thread(target=run_leaderboard_saver, daemon=True).start()
+    # Long-poll so Telegram holds each getUpdates open instead of returning empty
+    application.run_polling(poll_interval=0.0, timeout=30)
+    flush_leaderboard()
 
 if __name__ == "__main__":
     main()